@@ -1,21 +1,46 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import boto3
+from boto3.s3.transfer import TransferConfig
 import os
+import logging
 import uuid
-import json
+import hashlib
+import orjson
+import threading
+import time
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
 from dotenv import load_dotenv
 import jwt
 from jwt import PyJWKClient
+from jwt.exceptions import PyJWKClientConnectionError
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.signers import CloudFrontSigner
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("diary")
+
 app = Flask(__name__)
 allowed_origins = os.getenv("ALLOWED_ORIGINS")
-CORS(app, origins=allowed_origins.split(",") if allowed_origins else "*")
+# Browsers may cache preflight responses for a day
+CORS(
+    app,
+    origins=allowed_origins.split(",") if allowed_origins else "*",
+    max_age=86400,
+    supports_credentials=False,
+    allow_headers=["Authorization", "Content-Type"],
+    methods=["GET", "POST", "DELETE"],
+)
 
 # S3 config
 S3_BUCKET = os.getenv("S3_BUCKET")
@@ -23,71 +48,400 @@ S3_REGION = os.getenv("S3_REGION")
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
+# CloudFront config (optional; media is served via presigned S3 URLs without it)
+CLOUDFRONT_DOMAIN = os.getenv("CLOUDFRONT_DOMAIN")
+CLOUDFRONT_KEY_ID = os.getenv("CLOUDFRONT_KEY_ID")
+CLOUDFRONT_PRIVATE_KEY = os.getenv("CLOUDFRONT_PRIVATE_KEY")
+
 # Clerk config
 CLERK_BASE_URL = os.getenv("CLERK_BASE_URL")
 
-# S3 client
+# S3 client; the connection pool covers the entry fetch pool (16), background
+# uploads (4 x 8 parts) and request threads (8) without discarding connections
 s3 = boto3.client(
     "s3",
     region_name=S3_REGION,
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
+    config=Config(max_pool_connections=64),
 )
 
+# Multipart settings for media uploads: files under 16 MB go up in one PUT,
+# larger ones in 16 MB parts across 8 threads
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 ** 2,
+    multipart_chunksize=16 * 1024 ** 2,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# Signed media URLs, cached per key until shortly before they expire
+MEDIA_URL_TTL = 3600
+MEDIA_URL_CACHE_SIZE = 10000
+_media_urls = OrderedDict()
+_media_urls_lock = threading.Lock()
+_cloudfront_signer = None
+_cloudfront_signer_lock = threading.Lock()
+
+def get_cloudfront_signer():
+    global _cloudfront_signer
+    if _cloudfront_signer is None:
+        with _cloudfront_signer_lock:
+            if _cloudfront_signer is None:
+                private_key = serialization.load_pem_private_key(
+                    CLOUDFRONT_PRIVATE_KEY.replace("\\n", "\n").encode(), password=None
+                )
+                _cloudfront_signer = CloudFrontSigner(
+                    CLOUDFRONT_KEY_ID,
+                    lambda message: private_key.sign(message, padding.PKCS1v15(), hashes.SHA1()),
+                )
+    return _cloudfront_signer
+
+def sign_media_url(key):
+    if CLOUDFRONT_DOMAIN and CLOUDFRONT_KEY_ID and CLOUDFRONT_PRIVATE_KEY:
+        return get_cloudfront_signer().generate_presigned_url(
+            f"https://{CLOUDFRONT_DOMAIN}/{key}",
+            date_less_than=datetime.utcnow() + timedelta(seconds=MEDIA_URL_TTL),
+        )
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": S3_BUCKET, "Key": key},
+        ExpiresIn=MEDIA_URL_TTL,
+    )
+
+def media_url_for(key):
+    now = time.time()
+    with _media_urls_lock:
+        cached = _media_urls.get(key)
+        if cached and now < cached[1]:
+            _media_urls.move_to_end(key)
+            return cached[0]
+
+    url = sign_media_url(key)
+    with _media_urls_lock:
+        _media_urls[key] = (url, now + MEDIA_URL_TTL - 60)
+        _media_urls.move_to_end(key)
+        if len(_media_urls) > MEDIA_URL_CACHE_SIZE:
+            _media_urls.popitem(last=False)
+    return url
+
+# Entries saved before s3_key was stored only have the URL
+def entry_media_key(entry):
+    return entry.get("s3_key") or entry["media_url"].split(".amazonaws.com/")[-1]
+
+# Clerk JWKS client, shared across requests so the JWK set isn't refetched per
+# call. Per-kid caching is left to _signing_keys below: PyJWKClient's own key
+# cache never expires, which would keep rotated-out keys trusted forever.
+_jwks_client = None
+_jwks_client_lock = threading.Lock()
+
+def get_jwks_client():
+    global _jwks_client
+    if _jwks_client is None:
+        with _jwks_client_lock:
+            if _jwks_client is None:
+                _jwks_client = PyJWKClient(
+                    f"{CLERK_BASE_URL}/.well-known/jwks.json",
+                    cache_keys=False,
+                    lifespan=3600,
+                )
+    return _jwks_client
+
+# Signing keys by kid, kept for an hour; stale keys are reused for up to
+# ten more minutes only if Clerk can't be reached, never if it dropped the kid
+SIGNING_KEY_TTL = 3600
+SIGNING_KEY_STALE_WHILE_ERROR = 600
+_signing_keys = {}
+_signing_keys_lock = threading.Lock()
+
+def get_signing_key(token):
+    kid = jwt.get_unverified_header(token).get("kid")
+    now = time.time()
+    with _signing_keys_lock:
+        cached = _signing_keys.get(kid)
+    if cached and now < cached[1]:
+        return cached[0]
+
+    try:
+        key = get_jwks_client().get_signing_key_from_jwt(token).key
+    except PyJWKClientConnectionError as e:
+        if cached and now < cached[1] + SIGNING_KEY_STALE_WHILE_ERROR:
+            logger.warning("⚠️ JWKS fetch failed, using stale key for kid %s: %s", kid, e)
+            return cached[0]
+        raise
+
+    with _signing_keys_lock:
+        _signing_keys[kid] = (key, now + SIGNING_KEY_TTL)
+    return key
+
+# Each entry is stored as its own object under entries/{user_id}/, so writes
+# touch a single key. Older data lives in one entries/{user_id}.json blob per
+# user and is split into per-entry objects the first time it's listed.
+def entry_key(user_id, entry_id):
+    return f"entries/{user_id}/{entry_id}.json"
+
+def legacy_entries_key(user_id):
+    return f"entries/{user_id}.json"
+
+# Thread pool for fetching entry objects in parallel, created on first use
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=16)
+    return _executor
+
+# Thread pool for media uploads that finish after the request has returned
+_upload_executor = None
+
+def get_upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        with _executor_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(max_workers=4)
+    return _upload_executor
+
+# Load a single entry object and its ETag, or (None, None) if it has gone away
+def load_entry_versioned(key):
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=key)
+        return orjson.loads(response["Body"].read()), response["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None, None
+        raise
+
+def load_entry(key):
+    return load_entry_versioned(key)[0]
+
+# Save a single entry object to S3, optionally only over the given ETag
+def save_entry(user_id, entry, if_match=None):
+    conditions = {"IfMatch": if_match} if if_match else {}
+    response = s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=entry_key(user_id, entry["id"]),
+        Body=orjson.dumps(entry),
+        ContentType="application/json",
+        **conditions
+    )
+    return response["ETag"]
+
+# A conditional save failed because the entry changed or was deleted
+def is_precondition_failure(e):
+    return e.response["Error"]["Code"] in ("PreconditionFailed", "NoSuchKey")
+
+# Split a legacy per-user blob into per-entry objects
+def migrate_legacy_entries(user_id):
+    entries = load_entry(legacy_entries_key(user_id))
+    if entries is None:
+        return []
+    for entry in entries:
+        save_entry(user_id, entry)
+    s3.delete_object(Bucket=S3_BUCKET, Key=legacy_entries_key(user_id))
+    logger.info("📦 Migrated %d legacy entries for %s.", len(entries), user_id)
+    return entries
+
+# Load one entry, migrating the user's legacy blob first if it's still there
+def find_entry(user_id, entry_id):
+    key = entry_key(user_id, entry_id)
+    entry = load_entry(key)
+    if entry is None and migrate_legacy_entries(user_id):
+        entry = load_entry(key)
+    return key, entry
+
 # Load per-user entries from S3
 def load_user_entries(user_id):
+    prefix = f"entries/{user_id}/"
+    keys = []
+    has_legacy = False
     try:
-        response = s3.get_object(Bucket=S3_BUCKET, Key=f"entries/{user_id}.json")
-        return json.load(response["Body"])
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"entries/{user_id}"):
+            for obj in page.get("Contents", []):
+                if obj["Key"].startswith(prefix):
+                    keys.append(obj["Key"])
+                elif obj["Key"] == legacy_entries_key(user_id):
+                    has_legacy = True
+
+        entries = [e for e in get_executor().map(load_entry, keys) if e]
+        if has_legacy:
+            entries.extend(migrate_legacy_entries(user_id))
     except ClientError as e:
-        if e.response["Error"]["Code"] == "NoSuchKey":
-            print(f"📁 No saved entries for {user_id}; starting fresh.")
-        else:
-            print("❌ Failed to load entries:", e)
+        logger.error("❌ Failed to load entries: %s", e)
         return []
 
-# Save per-user entries to S3
-def save_user_entries(user_id, entries):
+    # A listing taken mid-migration can see an entry in both places
+    entries = list({e["id"]: e for e in entries}.values())
+    entries.sort(key=lambda e: e["created_at"])
+    return entries
+
+# Whether the media object for an entry made it to S3
+def media_exists(file_key):
     try:
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=f"entries/{user_id}.json",
-            Body=json.dumps(entries),
-            ContentType="application/json"
+        s3.head_object(Bucket=S3_BUCKET, Key=file_key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+
+# Conditional entry saves are retried this many times before giving up
+SAVE_ATTEMPTS = 5
+
+# Upload a saved media file in the background and mark its entry ready
+def upload_media(user_id, entry, etag, file_key, tmp_dir, tmp_path, content_type):
+    try:
+        s3.upload_file(
+            tmp_path,
+            S3_BUCKET,
+            file_key,
+            ExtraArgs={"ContentType": content_type},
+            Config=TRANSFER_CONFIG,
         )
-        print(f"💾 Saved entries for {user_id} to S3.")
+        logger.debug("⬆️ Uploaded file: %s", file_key)
+        entry["status"] = "ready"
+    except Exception as e:
+        logger.error("❌ Failed to upload file: %s", e)
+        entry["status"] = "failed"
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Apply only the status change, conditionally on the version last read.
+    # If someone else wrote the entry meanwhile, merge the status into their
+    # version and retry; if it's gone, it was deleted mid-upload.
+    key = entry_key(user_id, entry["id"])
+    status = entry["status"]
+    try:
+        for _ in range(SAVE_ATTEMPTS):
+            try:
+                save_entry(user_id, {**entry, "status": status}, if_match=etag)
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "ConditionalRequestConflict":
+                    time.sleep(0.1)
+                    continue
+                if not is_precondition_failure(e):
+                    raise
+            entry, etag = load_entry_versioned(key)
+            if entry is None:
+                break
+        else:
+            logger.error("❌ Gave up saving entry %s after %d attempts", key, SAVE_ATTEMPTS)
+            return
+    except Exception as e:
+        logger.error("❌ Failed to save entry: %s", e)
+        return
+
+    try:
+        s3.delete_object(Bucket=S3_BUCKET, Key=file_key)
     except Exception as e:
-        print("❌ Failed to save entries:", e)
+        logger.error("❌ Failed to delete from S3: %s", e)
+
+# Entries whose worker died mid-upload (deploy, worker timeout) stay
+# 'processing' forever; once they're old enough, settle them by whether the
+# media made it to S3
+PROCESSING_TIMEOUT = timedelta(hours=1)
+
+# Uploads are staged under one directory so a dead worker's files can be found
+UPLOAD_TMP_ROOT = os.path.join(tempfile.gettempdir(), "photo-diary-uploads")
+os.makedirs(UPLOAD_TMP_ROOT, exist_ok=True)
+
+# Remove staged uploads old enough that no live worker can still be using them
+def sweep_upload_dirs():
+    cutoff = time.time() - PROCESSING_TIMEOUT.total_seconds()
+    with os.scandir(UPLOAD_TMP_ROOT) as it:
+        for item in it:
+            try:
+                if item.is_dir() and item.stat().st_mtime < cutoff:
+                    shutil.rmtree(item.path, ignore_errors=True)
+            except OSError:
+                pass
+
+sweep_upload_dirs()
+
+def recover_stale_entry(user_id, entry):
+    if entry.get("status") != "processing":
+        return entry
+    if datetime.fromisoformat(entry["created_at"]) > datetime.utcnow() - PROCESSING_TIMEOUT:
+        return entry
+
+    current, etag = load_entry_versioned(entry_key(user_id, entry["id"]))
+    if current is None or current.get("status") != "processing":
+        return current
+
+    current["status"] = "ready" if media_exists(entry_media_key(current)) else "failed"
+    sweep_upload_dirs()
+    try:
+        save_entry(user_id, current, if_match=etag)
+        logger.info("🩹 Recovered stale entry %s as %s.", current["id"], current["status"])
+    except ClientError as e:
+        if not is_precondition_failure(e):
+            raise
+    return current
+
+# Entry as returned to clients: media_url is signed, and None until the
+# media has actually been uploaded
+def present_entry(entry):
+    ready = entry.get("status", "ready") == "ready"
+    return {**entry, "media_url": media_url_for(entry_media_key(entry)) if ready else None}
+
+# JSON response serialized with orjson, for large payloads
+def fast_jsonify(data):
+    return app.response_class(orjson.dumps(data), mimetype="application/json")
+
+# Tokens that already passed verification, by hash, until they expire
+TOKEN_CACHE_SIZE = 1024
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
 
 # Verify Clerk token
 def verify_token(headers):
-    token = headers.get("Authorization", "").replace("Bearer ", "")
+    auth = headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        logger.debug("❌ No token provided")
+        return None
+
+    token = auth[7:]
     if not token:
-        print("❌ No token provided")
+        logger.debug("❌ No token provided")
         return None
 
-    jwks_url = f"{CLERK_BASE_URL}/.well-known/jwks.json"
+    token_hash = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(token_hash)
+    if cached and time.time() < cached[1] - 5:
+        return cached[0]
+
     try:
-        jwks_client = PyJWKClient(jwks_url)
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        signing_key = get_signing_key(token)
         decoded_token = jwt.decode(
             token,
-            signing_key.key,
+            signing_key,
             algorithms=["RS256"],
             audience=None,
             issuer=CLERK_BASE_URL,
         )
         user_id = decoded_token.get("sub")
-        print("✅ Token verified for user_id:", user_id)
+        logger.debug("✅ Token verified for user_id: %s", user_id)
+        if user_id and "exp" in decoded_token:
+            with _verified_tokens_lock:
+                _verified_tokens[token_hash] = (user_id, decoded_token["exp"])
+                if len(_verified_tokens) > TOKEN_CACHE_SIZE:
+                    _verified_tokens.popitem(last=False)
         return user_id
     except Exception as e:
-        print("❌ JWT verification failed:", str(e))
+        logger.warning("❌ JWT verification failed: %s", e)
         return None
 
 # Upload endpoint
 @app.route("/api/upload", methods=["POST"])
 def upload():
-    print("📥 Received POST /api/upload")
+    logger.debug("📥 Received POST /api/upload")
     user_id = verify_token(request.headers)
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
@@ -99,24 +453,47 @@ def upload():
         return jsonify({"error": "No file uploaded"}), 400
 
     ext = secure_filename(file.filename).split('.')[-1]
-    file_key = f"user_uploads/{user_id}/{uuid.uuid4()}.{ext}"
 
-    s3.upload_fileobj(file, S3_BUCKET, file_key, ExtraArgs={"ContentType": file.content_type})
-    print(f"⬆️ Uploaded file: {file_key}")
+    file_key = f"user_uploads/{user_id}/{uuid.uuid4()}.{ext}"
     media_url = f"https://{S3_BUCKET}.s3.{S3_REGION}.amazonaws.com/{file_key}"
 
+    # Keep the file on disk until the background upload is done with it
+    tmp_dir = tempfile.mkdtemp(dir=UPLOAD_TMP_ROOT)
+    tmp_path = os.path.join(tmp_dir, f"upload.{ext}")
+    try:
+        file.save(tmp_path, buffer_size=1 << 20)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
     entry = {
         "id": str(uuid.uuid4()),
         "media_url": media_url,
+        "s3_key": file_key,
         "caption": caption,
+        "status": "processing",
         "created_at": datetime.utcnow().isoformat()
     }
 
-    entries = load_user_entries(user_id)
-    entries.append(entry)
-    save_user_entries(user_id, entries)
+    try:
+        etag = save_entry(user_id, entry)
+        logger.debug("💾 Saved entry %s for %s to S3.", entry["id"], user_id)
+    except Exception as e:
+        logger.error("❌ Failed to save entry: %s", e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return jsonify({"error": "Failed to save entry"}), 500
 
-    return jsonify(entry)
+    get_upload_executor().submit(
+        upload_media,
+        user_id,
+        dict(entry),
+        etag,
+        file_key,
+        tmp_dir,
+        tmp_path,
+        file.content_type,
+    )
+    return jsonify(present_entry(entry)), 202
 
 # Get entries
 @app.route("/api/entries", methods=["GET"])
@@ -126,7 +503,31 @@ def get_entries():
         return jsonify({"error": "Unauthorized"}), 401
 
     entries = load_user_entries(user_id)
-    return jsonify(entries)
+    try:
+        entries = [recover_stale_entry(user_id, e) for e in entries]
+    except ClientError as e:
+        logger.error("❌ Failed to recover entries: %s", e)
+    return fast_jsonify([present_entry(e) for e in entries if e])
+
+# Entry status
+@app.route("/api/entry/<entry_id>/status", methods=["GET"])
+def entry_status(entry_id):
+    user_id = verify_token(request.headers)
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        _, entry = find_entry(user_id, secure_filename(entry_id))
+        if entry:
+            entry = recover_stale_entry(user_id, entry)
+    except ClientError as e:
+        logger.error("❌ Failed to load entry: %s", e)
+        return jsonify({"error": "Failed to load entry"}), 500
+
+    if not entry:
+        return jsonify({"error": "Entry not found"}), 404
+
+    return jsonify({"id": entry["id"], "status": entry.get("status", "ready")})
 
 # Delete entry
 @app.route("/api/entry/<entry_id>", methods=["DELETE"])
@@ -135,28 +536,29 @@ def delete_entry(entry_id):
     if not user_id:
         return jsonify({"error": "Unauthorized"}), 401
 
-    entries = load_user_entries(user_id)
-    updated_entries = []
-    deleted_entry = None
-
-    for entry in entries:
-        if entry["id"] == entry_id:
-            deleted_entry = entry
-        else:
-            updated_entries.append(entry)
+    try:
+        key, deleted_entry = find_entry(user_id, secure_filename(entry_id))
+    except ClientError as e:
+        logger.error("❌ Failed to load entry: %s", e)
+        return jsonify({"error": "Failed to load entry"}), 500
 
     if not deleted_entry:
         return jsonify({"error": "Entry not found"}), 404
 
     try:
-        media_url = deleted_entry["media_url"]
-        s3_key = media_url.split(f".amazonaws.com/")[-1]
+        s3.delete_object(Bucket=S3_BUCKET, Key=key)
+        logger.debug("🗑️ Deleted entry: %s", key)
+    except ClientError as e:
+        logger.error("❌ Failed to delete entry: %s", e)
+        return jsonify({"error": "Failed to delete entry"}), 500
+
+    try:
+        s3_key = entry_media_key(deleted_entry)
         s3.delete_object(Bucket=S3_BUCKET, Key=s3_key)
-        print(f"🗑️ Deleted from S3: {s3_key}")
+        logger.debug("🗑️ Deleted from S3: %s", s3_key)
     except Exception as e:
-        print("❌ Failed to delete from S3:", e)
+        logger.error("❌ Failed to delete from S3: %s", e)
 
-    save_user_entries(user_id, updated_entries)
     return jsonify({"success": True})
 
 # Health check
@@ -0,0 +1,11 @@
+import os
+
+# gthread workers: threads cover S3 I/O, processes get around the GIL.
+# The app isn't preloaded, so each worker builds its own clients and pools,
+# which is why the default worker count is kept small; set WEB_CONCURRENCY
+# to size it for the instance.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+preload_app = False